@@ -28,8 +28,8 @@ try:
 except ImportError:
     sentry_logging, sentry_tornado = None, None
 
-from imbi import (cors, endpoints, errors, keychain, openapi, permissions,
-                  stats, transcoders, version)
+from imbi import (automations, cors, endpoints, errors, keychain, openapi,
+                  permissions, stats, transcoders, version)
 from imbi.clients import opensearch
 from imbi.endpoints import default
 
@@ -167,8 +167,16 @@ class Application(sprockets_postgres.ApplicationMixin, app.Application):
         self._ready_to_serve = True
         LOGGER.info('Application startup complete')
 
+    async def _on_postgres_connect(self, conn) -> None:
+        """Invoked for each new Postgres connection in the pool, preparing
+        the frequently executed automation statements so they are only
+        parsed and planned once per connection"""
+        await super()._on_postgres_connect(conn)
+        await automations.prepare_statements(conn)
+
     async def on_shutdown(self, *_args, **_kwargs) -> None:
         await self.opensearch.stop()
+        await automations.shutdown()
 
     def validate_request(self, request: httputil.HTTPServerRequest) -> None:
         """Validate the inbound request, raising any number of OpenAPI
@@ -0,0 +1,27 @@
+import logging
+
+import psycopg2
+
+from imbi.automations import gitlab
+
+LOGGER = logging.getLogger(__name__)
+
+
+async def prepare_statements(conn) -> None:
+    """Prepare the SQL statements used by the automations on `conn`.
+
+    Failures are logged instead of raised so that a schema problem only
+    breaks the automation using the statement and not the connection.
+
+    """
+    async with conn.cursor() as cursor:
+        for sql in gitlab.PREPARED_STATEMENTS:
+            try:
+                await cursor.execute(sql)
+            except psycopg2.Error as error:
+                LOGGER.warning('Failed to prepare %r: %s', sql, error)
+
+
+async def shutdown() -> None:
+    """Stop the worker processes started by the automations."""
+    await gitlab.shutdown_format_pool()
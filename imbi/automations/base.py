@@ -30,14 +30,24 @@ class Automation:
 
     async def _get_project(self, project_id: int) \
             -> typing.Optional[models.Project]:
-        project = await models.project(project_id, self.application)
+        return self._check_project(
+            project_id, await models.project(project_id, self.application))
+
+    def _check_project(self, project_id: int,
+                       project: typing.Optional[models.Project]) \
+            -> typing.Optional[models.Project]:
         if not project:
             self._add_error('project not found for {}', project_id)
         return None if self._has_error() else project
 
     async def _get_gitlab_token(self) \
             -> typing.Optional[oauth2.IntegrationToken]:
-        tokens = await self.user.fetch_integration_tokens('gitlab')
+        return self._check_gitlab_tokens(
+            await self.user.fetch_integration_tokens('gitlab'))
+
+    def _check_gitlab_tokens(
+            self, tokens: typing.List[oauth2.IntegrationToken]) \
+            -> typing.Optional[oauth2.IntegrationToken]:
         if not tokens:
             self._add_error('GitLab token not found for current user')
             return None
@@ -1,15 +1,27 @@
 import asyncio
+import collections
+import concurrent.futures
 import dataclasses
+import functools
+import hashlib
+import multiprocessing
+import os
 import pathlib
-import re
+import string
+import subprocess  # nosec
 import tempfile
 import typing
 
+import cookiecutter.config
 import cookiecutter.main
-import flatdict
+import cookiecutter.repository
+import cookiecutter.vcs
+import isort
+import isort.exceptions
 import sprockets_postgres
 from cookiecutter import exceptions
 from jinja2 import exceptions as jinja_exceptions
+from yapf.yapflib import yapf_api
 
 from imbi import models, oauth2
 from imbi.automations import base
@@ -20,18 +32,18 @@ if typing.TYPE_CHECKING:
 
 class GitLabCreateProjectAutomation(base.Automation):
 
-    INSERT_SQL = re.sub(
-        r'\s+', ' ', """\
-        INSERT INTO v1.project_links
-                    (project_id, link_type_id, created_by, url)
-             VALUES (%(project_id)s, %(link_type_id)s,
-                     %(username)s, %(url)s)""")
+    PREPARE_SQL = (
+        'PREPARE gitlab_create_and_link '
+        '(integer, integer, integer, text, text) AS '
+        'WITH updated AS (UPDATE v1.projects SET gitlab_project_id = $2 '
+        'WHERE id = $1 RETURNING id) '
+        'INSERT INTO v1.project_links '
+        '(project_id, link_type_id, created_by, url) '
+        'SELECT id, $3, $4, $5 FROM updated WHERE $3 IS NOT NULL')
 
-    UPDATE_SQL = re.sub(
-        r'\s+', ' ', """\
-        UPDATE v1.projects
-           SET gitlab_project_id = %(gitlab_project_id)s
-         WHERE id = %(project_id)s""")
+    CREATE_AND_LINK_SQL = (
+        'EXECUTE gitlab_create_and_link(%(project_id)s, '
+        '%(gitlab_project_id)s, %(link_type_id)s, %(username)s, %(url)s)')
 
     def __init__(self, application: 'app.Application', project_id: int,
                  current_user: 'user.User',
@@ -61,21 +73,16 @@ class GitLabCreateProjectAutomation(base.Automation):
             self._gitlab_parent,
             self._project.name,
             description=self._project.description)
-        await self.db.execute(self.UPDATE_SQL, {
-            'project_id': self._project.id,
-            'gitlab_project_id': project.id,
-        })
-
         link_id = self.automation_settings['gitlab'].get(
             'project_link_type_id')
-        if link_id:
-            await self.db.execute(
-                self.INSERT_SQL, {
-                    'link_type_id': link_id,
-                    'project_id': self._project.id,
-                    'url': project.web_url,
-                    'username': self.user.username,
-                })
+        await self.db.execute(
+            self.CREATE_AND_LINK_SQL, {
+                'gitlab_project_id': project.id,
+                'link_type_id': link_id or None,
+                'project_id': self._project.id,
+                'url': project.web_url,
+                'username': self.user.username,
+            })
         return project
 
     async def _get_project(self,
@@ -101,6 +108,149 @@ class GitLabCreateProjectAutomation(base.Automation):
         return gitlab_parent
 
 
+# RAM backed directory used for expanding cookiecutters when it exists
+# and the automations.tmp_dir setting is not set
+_PULL_TIMEOUT = 60
+_SHM_DIR = '/dev/shm'  # nosec
+
+_KEY_TRANSLATION = str.maketrans(' ', '_')
+_SLUG_TRANSLATION = str.maketrans('-' + string.ascii_uppercase,
+                                  '_' + string.ascii_lowercase)
+
+
+def _norm_keys(value: typing.Dict[str, str]) -> typing.Dict[str, str]:
+    """Lowercase the keys of `value`, replacing spaces with underscores"""
+    return {k.lower().translate(_KEY_TRANSLATION): v for k, v in value.items()}
+
+
+def _shallow_asdict(obj) -> dict:
+    """Return the fields of the dataclass instance `obj` as a dict without
+    the recursive copying done by :func:`dataclasses.asdict`."""
+    return {f.name: getattr(obj, f.name) for f in dataclasses.fields(obj)}
+
+
+def _flatten(value: dict, prefix: str = '') \
+        -> typing.Iterator[typing.Tuple[str, typing.Any]]:
+    """Yield ``(key, value)`` pairs for the leaves of the nested dict
+    `value`, joining the keys of each level with an underscore. Nested
+    dataclass instances are flattened as if they were dicts."""
+    for key, item in value.items():
+        key = f'{prefix}_{key}' if prefix else str(key)
+        if dataclasses.is_dataclass(item):
+            item = _shallow_asdict(item)
+        if isinstance(item, dict) and item:
+            yield from _flatten(item, key)
+        else:
+            yield key, item
+
+
+def _iter_py(root: str) -> typing.Iterator[str]:
+    """Yield the paths of the Python files under `root`, relying on the
+    file type cached by :func:`os.scandir` instead of stat-ing each entry"""
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_py(entry.path)
+            elif entry.name.endswith('.py') \
+                    and entry.is_file(follow_symlinks=False):
+                yield entry.path
+
+
+def _format_one(path: str, isort_config: typing.Optional[isort.Config],
+                yapf_style: typing.Union[dict, str, None]) -> bytes:
+    """Run isort and yapf over the source in `path`, returning the
+    formatted source. Either is skipped when its configuration is
+    :data:`None`. The file itself is left as it is.
+
+    This is a module-level function so that it can be pickled and run
+    in a worker process.
+
+    """
+    try:
+        with open(path, encoding='utf-8') as handle:
+            source = handle.read()
+        if isort_config is not None:
+            try:
+                source = isort.code(source,
+                                    config=isort_config,
+                                    file_path=pathlib.Path(path))
+            except isort.exceptions.FileSkipped:
+                pass
+        if yapf_style is not None:
+            source, _changed = yapf_api.FormatCode(source,
+                                                   filename=path,
+                                                   style_config=yapf_style)
+    except Exception as error:
+        # isort and yapf raise a wide range of errors, hand back a single
+        # type that also names the file that could not be formatted
+        raise ReformatError('failed to reformat {}: {}'.format(
+            os.path.basename(path), error)) from None
+    return source.encode('utf-8')
+
+
+# Local clones of cookiecutter templates by URL, shared by all automations
+# in the process. The lock serializes use of a clone so that one
+# automation does not update it while another is rendering from it.
+_template_dirs: typing.Dict[str, str] = {}
+_template_locks: typing.DefaultDict[str, asyncio.Lock] = \
+    collections.defaultdict(asyncio.Lock)
+
+# cookiecutter changes the working directory of the whole process while it
+# renders a template, so only one render may run at a time, whatever the
+# template. The lock is created on first use so it belongs to the running
+# event loop.
+_render_lock: typing.Optional[asyncio.Lock] = None
+
+
+def _get_render_lock() -> asyncio.Lock:
+    global _render_lock
+    if _render_lock is None:
+        _render_lock = asyncio.Lock()
+    return _render_lock
+
+
+# Worker processes that reformat generated files, shared by every initial
+# commit in the process so that the number of workers is bounded by the
+# CPU count and not by the number of concurrent automations. Workers are
+# started from a fork server since forking the multi-threaded server
+# process itself can deadlock. The semaphore only hands the pool as many
+# files as it has workers so that pending work waits in the event loop
+# instead of queueing up in the pool.
+_format_pool: typing.Optional[concurrent.futures.ProcessPoolExecutor] = None
+_format_semaphore: typing.Optional[asyncio.Semaphore] = None
+
+
+def _get_format_pool() \
+        -> typing.Tuple[concurrent.futures.ProcessPoolExecutor,
+                        asyncio.Semaphore]:
+    global _format_pool, _format_semaphore
+    if _format_pool is None:
+        workers = os.cpu_count() or 1
+        _format_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('forkserver'))
+        _format_semaphore = asyncio.Semaphore(workers)
+    return _format_pool, _format_semaphore
+
+
+def _discard_format_pool(pool: concurrent.futures.Executor) -> None:
+    """Stop using `pool` so that the next run starts a new one, used when
+    a worker died and the pool can no longer take work."""
+    global _format_pool, _format_semaphore
+    if _format_pool is pool:
+        _format_pool, _format_semaphore = None, None
+    pool.shutdown(wait=False)
+
+
+async def shutdown_format_pool() -> None:
+    """Shut down the reformatting worker processes, waiting for the files
+    they are working on."""
+    global _format_pool, _format_semaphore
+    pool, _format_pool, _format_semaphore = _format_pool, None, None
+    if pool is not None:
+        await asyncio.get_running_loop().run_in_executor(None, pool.shutdown)
+
+
 class CookieCutterError(Exception):
     """Raised when there is an error applying the cookiecutter"""
 
@@ -109,14 +259,17 @@ class InitialCommitError(Exception):
     """Raised when there is an error creating the initial commit"""
 
 
+class ReformatError(Exception):
+    """Raised when a generated file could not be reformatted"""
+
+
 class GitLabInitialCommitAutomation(base.Automation):
 
-    GET_COOKIE_CUTTER = re.sub(
-        r'\s+', ' ', """\
-        SELECT name, project_type_id, url
-          FROM v1.cookie_cutters
-         WHERE type='project'
-           AND url = %(url)s""")
+    PREPARE_SQL = ('PREPARE gitlab_get_cookie_cutter (text) AS '
+                   'SELECT name, project_type_id, url FROM v1.cookie_cutters '
+                   "WHERE type='project' AND url = $1")
+
+    GET_COOKIE_CUTTER = 'EXECUTE gitlab_get_cookie_cutter(%(url)s)'
 
     def __init__(self, application: 'app.Application', project_id: int,
                  cookie_cutter: str, current_user: 'user.User',
@@ -131,10 +284,19 @@ class GitLabInitialCommitAutomation(base.Automation):
         self._token: typing.Optional[oauth2.IntegrationToken] = None
 
     async def prepare(self) -> typing.List[str]:
-        self._project = await self._get_project(self._imbi_project_id)
-        self._token = await self._get_gitlab_token()
-        self._cookie_cutter = await self._get_cookie_cutter(
-            self._cookie_cutter_name)
+        # The lookups run concurrently, but their results are checked in a
+        # fixed order so the errors match running them one after another
+        project, tokens, self._cookie_cutter = await asyncio.gather(
+            models.project(self._imbi_project_id, self.application),
+            self.user.fetch_integration_tokens('gitlab'),
+            self._get_cookie_cutter(self._cookie_cutter_name))
+        self._project = self._check_project(self._imbi_project_id, project)
+        self._token = self._check_gitlab_tokens(tokens)
+        if self._cookie_cutter is None:
+            self._add_error('Cookie cutter {} does not exist',
+                            self._cookie_cutter_name)
+        if self._project is None:
+            return self.errors
 
         if not self._has_error() \
                 and (self._project.type.id
@@ -158,22 +320,17 @@ class GitLabInitialCommitAutomation(base.Automation):
         self.logger.info('generating initial commit for %s (%s) from %s',
                          self._project.slug, self._project.id,
                          self._cookie_cutter.url)
-        context = dataclasses.asdict(self._project)
-        links = {
-            k.lower().replace(' ', '_'): v
-            for k, v in context['links'].items()
-        }
-        urls = {
-            k.lower().replace(' ', '_'): v
-            for k, v in context['urls'].items()
-        }
-        context.update({
+        sonar_key = None
+        if (self.automation_settings.get('sonarqube') or {}).get('url'):
+            sonar_key = sonarqube.generate_key(self._project)
+        context = {
+            **_shallow_asdict(self._project),
             'environments': ','.join(self._project.environments),
             'gitlab': {
                 'namespace_id': self._gitlab_project.namespace.id,
                 'project_id': self._project.gitlab_project_id
             },
-            'links': links,
+            'links': _norm_keys(self._project.links),
             'pagerduty': {
                 'service_id': None,
             },
@@ -185,15 +342,10 @@ class GitLabInitialCommitAutomation(base.Automation):
                 'team': None
             },
             'sonarqube': {
-                'key': None
+                'key': sonar_key
             },
-            'urls': urls
-        })
-        if self.automation_settings['sonarqube'].get('url'):
-            context.update(
-                {'sonarqube': {
-                    'key': sonarqube.generate_key(self._project)
-                }})
+            'urls': _norm_keys(self._project.urls)
+        }
 
         for var in [
                 'gitlab_project_id', 'pagerduty_service_id',
@@ -202,17 +354,21 @@ class GitLabInitialCommitAutomation(base.Automation):
             del context[var]
 
         self.logger.debug('Context %r', {'project': context})
-        with tempfile.TemporaryDirectory() as tmp_dir:
+        extra_context = dict(_flatten({'project': context}))
+        tmp_root = self.automation_settings.get('tmp_dir')
+        if tmp_root is None and os.path.isdir(_SHM_DIR):
+            tmp_root = _SHM_DIR
+        with tempfile.TemporaryDirectory(dir=tmp_root) as tmp_dir:
             self.logger.debug('expanding %s for project %s in %s',
                               self._cookie_cutter.url, self._project.id,
                               tmp_dir)
+            loop = asyncio.get_running_loop()
             try:
-                project_dir = cookiecutter.main.cookiecutter(
-                    self._cookie_cutter.url,
-                    extra_context=dict(
-                        flatdict.FlatDict({'project': context}, '_')),
-                    no_input=True,
-                    output_dir=tmp_dir)
+                async with _template_locks[self._cookie_cutter.url]:
+                    template = await loop.run_in_executor(
+                        None, self._fetch_template)
+                    project_dir = await self._render(template, extra_context,
+                                                     tmp_dir)
             except (exceptions.ContextDecodingException,
                     exceptions.NonTemplatedInputDirException,
                     exceptions.UndefinedVariableInTemplate,
@@ -220,31 +376,137 @@ class GitLabInitialCommitAutomation(base.Automation):
                 raise CookieCutterError(str(error))
 
             project_dir = pathlib.Path(project_dir)
-            """Disabling for the time being
-            self.logger.debug('reformatting project files')
-            isort_cfg = self.automation_settings['isort']
-            isort_cfg.setdefault('known_first_party', [])
-            isort_cfg['known_first_party'].append(context['package_name'])
-            yapf_style = self.automation_settings['yapf']
-
-            for py_file in project_dir.rglob('*.py'):
-                isort.api.sort_file(py_file, **isort_cfg)
-                yapf_api.FormatFile(
-                    str(py_file), style_config=yapf_style,
-                    in_place=True, logger=None)
-            """
+            blobs = {}
+            if self.automation_settings.get('isort') \
+                    or self.automation_settings.get('yapf'):
+                try:
+                    blobs = await self._reformat_project(project_dir)
+                except (ReformatError,
+                        concurrent.futures.BrokenExecutor) as error:
+                    raise InitialCommitError(str(error))
 
             self.logger.debug('committing to GitLab')
             commit_info = await self._gitlab.commit_tree(
-                self._gitlab_project, project_dir,
-                'Initial commit (automated)')
+                self._gitlab_project,
+                project_dir,
+                'Initial commit (automated)',
+                blobs=blobs)
 
             return commit_info
 
+    @staticmethod
+    async def _render(template: str, extra_context: dict,
+                      output_dir: str) -> str:
+        """Render `template` into `output_dir` in the default executor,
+        returning the path of the generated project."""
+        async with _get_render_lock():
+            return await asyncio.get_running_loop().run_in_executor(
+                None,
+                functools.partial(cookiecutter.main.cookiecutter,
+                                  template,
+                                  extra_context=extra_context,
+                                  no_input=True,
+                                  output_dir=output_dir))
+
+    def _fetch_template(self) -> str:
+        """Return a local clone of the cookiecutter template, cloning it
+        into the cache directory the first time it is used and pulling
+        the existing clone after that."""
+        url = self._cookie_cutter.url
+        if cookiecutter.repository.is_zip_file(url) \
+                or not cookiecutter.repository.is_repo_url(url):
+            return url
+        repo_dir = _template_dirs.get(url)
+        if repo_dir is not None and os.path.isdir(repo_dir):
+            repo_type, _repo_url = cookiecutter.vcs.identify_repo(url)
+            command = [repo_type, 'pull']
+            command.append('--ff-only' if repo_type == 'git' else '--update')
+            try:
+                subprocess.check_output(  # nosec
+                    command,
+                    cwd=repo_dir,
+                    stderr=subprocess.STDOUT,
+                    timeout=_PULL_TIMEOUT)
+            except (subprocess.CalledProcessError,
+                    subprocess.TimeoutExpired) as error:
+                self.logger.warning('failed to update %s, cloning again: %s',
+                                    repo_dir, error.output)
+            else:
+                return repo_dir
+        cache_dir = (self.automation_settings.get('cookiecutter_cache_dir') or
+                     cookiecutter.config.DEFAULT_CONFIG['cookiecutters_dir'])
+        # cookiecutter names the clone after the last segment of the URL
+        # and removes whatever is already there, so give each URL its own
+        # directory to keep templates with the same name apart
+        cache_dir = os.path.join(cache_dir,
+                                 hashlib.sha256(url.encode()).hexdigest())
+        self.logger.debug('cloning %s into %s', url, cache_dir)
+        repo_dir = cookiecutter.vcs.clone(url,
+                                          clone_to_dir=cache_dir,
+                                          no_input=True)
+        _template_dirs[url] = repo_dir
+        return repo_dir
+
+    async def _reformat_project(self, project_dir: pathlib.Path) \
+            -> typing.Dict[str, bytes]:
+        """Format the Python files in `project_dir`, returning the
+        formatted source keyed by the path relative to `project_dir`."""
+        self.logger.debug('reformatting project files')
+        isort_cfg = self.automation_settings.get('isort')
+        yapf_style = self.automation_settings.get('yapf') or None
+
+        files = list(_iter_py(str(project_dir)))
+        if not files:
+            return {}
+
+        isort_config = None
+        if isort_cfg:
+            package_name = self._project.slug.translate(_SLUG_TRANSLATION)
+            # Resolve the isort settings once for the project instead of
+            # once per file, which is what passing them as kwargs does.
+            # The shared settings are copied, not modified, so package
+            # names do not pile up in them across runs.
+            settings = {'settings_path': str(project_dir), **isort_cfg}
+            settings['known_first_party'] = [
+                *isort_cfg.get('known_first_party', []), package_name
+            ]
+            isort_config = isort.Config(**settings)
+
+        loop = asyncio.get_running_loop()
+        pool, semaphore = _get_format_pool()
+
+        async def format_file(py_file: str) -> bytes:
+            async with semaphore:
+                try:
+                    return await loop.run_in_executor(pool, _format_one,
+                                                      py_file, isort_config,
+                                                      yapf_style)
+                except concurrent.futures.BrokenExecutor:
+                    _discard_format_pool(pool)
+                    raise
+
+        # Let every file finish before raising so that no worker is still
+        # reading when the temporary directory is removed
+        contents = await asyncio.gather(*[format_file(f) for f in files],
+                                        return_exceptions=True)
+        for content in contents:
+            if isinstance(content, BaseException):
+                raise content
+        return {
+            os.path.relpath(py_file, project_dir): content
+            for py_file, content in zip(files, contents)
+        }
+
     async def _get_cookie_cutter(self, url: str) \
             -> typing.Optional[models.CookieCutter]:
         result = await self.db.execute(self.GET_COOKIE_CUTTER, {'url': url})
         if result.row_count != 0:
             return models.CookieCutter(**result.row)
-        else:
-            self._add_error('Cookie cutter {} does not exist', url)
+
+
+# Prepared on every new Postgres connection by
+# imbi.automations.prepare_statements
+PREPARED_STATEMENTS = [
+    GitLabCreateProjectAutomation.PREPARE_SQL,
+    GitLabInitialCommitAutomation.PREPARE_SQL,
+]
@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import logging
 import pathlib
@@ -158,24 +159,47 @@ class GitLabClient(sprockets.mixins.http.HTTPClientMixin):
                                          title='GitLab API Failure',
                                          gitlab_response=response.body)
 
-    async def commit_tree(self, project_info: ProjectInfo,
-                          project_dir: pathlib.Path, commit_message: str):
+    async def commit_tree(self,
+                          project_info: ProjectInfo,
+                          project_dir: pathlib.Path,
+                          commit_message: str,
+                          blobs: typing.Optional[dict] = None):
+        """Commit the files in `project_dir` to the default branch.
+
+        `blobs` maps paths relative to `project_dir` to the content to
+        commit for them, for files whose content is already in memory.
+        All other files are read from disk.
+
+        """
         self.logger.info('creating commit for %s', project_info.id)
 
-        files = [path for path in project_dir.glob('**/*') if path.is_file()]
+        files = {
+            str(path.relative_to(project_dir)): path
+            for path in project_dir.glob('**/*') if path.is_file()
+        }
         self.logger.debug('found %d files in %s', len(files), project_dir)
 
+        contents: typing.Dict[str, bytes] = dict(blobs or {})
+        unread = [name for name in files if name not in contents]
+        loop = asyncio.get_running_loop()
+        read = await asyncio.gather(*[
+            loop.run_in_executor(None, files[name].read_bytes)
+            for name in unread
+        ])
+        contents.update(zip(unread, read))
+
         actions = [{
             'action': 'create',
-            'content': base64.b64encode(file.read_bytes()).decode('ascii'),
+            'content': base64.b64encode(contents[name]).decode('ascii'),
             'encoding': 'base64',
-            'file_path': str(file.relative_to(project_dir)),
-        } for file in files]
+            'file_path': name,
+        } for name in files]
         actions.extend([{
             'action': 'chmod',
             'execute_filemode': True,
-            'file_path': str(file.relative_to(project_dir)),
-        } for file in files if file.stat().st_mode & stat.S_IXUSR])
+            'file_path': name,
+        } for name, path in files.items()
+                        if path.stat().st_mode & stat.S_IXUSR])
         self.logger.debug('creating commit with %d actions', len(actions))
 
         project_url = yarl.URL(project_info.links.self)
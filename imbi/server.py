@@ -150,6 +150,8 @@ def load_configuration(config: str, debug: bool) -> typing.Tuple[dict, dict]:
 
     settings = {
         'automations': {
+            'cookiecutter_cache_dir': automations.get(
+                'cookiecutter_cache_dir'),
             'gitlab': automations_gitlab,
             'grafana': {
                 'enabled': automations_grafana.get('enabled', False),
@@ -166,6 +168,7 @@ def load_configuration(config: str, debug: bool) -> typing.Tuple[dict, dict]:
                     'project_link_type_id'),
                 'url': automations_sonar.get('url')
             },
+            'tmp_dir': automations.get('tmp_dir'),
             # see https://github.com/google/yapf#knobs
             'yapf': automations.get('yapf', {}),
         },
@@ -0,0 +1,507 @@
+import asyncio
+import concurrent.futures
+import concurrent.futures.process
+import datetime
+import os
+import pathlib
+import subprocess
+import tempfile
+import unittest
+import unittest.mock
+import uuid
+
+import psycopg2
+
+from imbi import automations, models
+from imbi.automations import gitlab
+from tests import base
+
+
+def create_project(**overrides) -> models.Project:
+    created_at = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+    values = {
+        'id': 3,
+        'created_at': created_at,
+        'created_by': 'test',
+        'last_modified_at': None,
+        'last_modified_by': None,
+        'namespace': models.Namespace(id=1,
+                                      created_at=created_at,
+                                      created_by='test',
+                                      last_modified_at=None,
+                                      last_modified_by=None,
+                                      name='Namespace',
+                                      slug='ns',
+                                      icon_class='fas fa-blind',
+                                      maintained_by=['team-a', 'team-b'],
+                                      gitlab_group_name='Group',
+                                      sentry_team_slug=None),
+        'project_type': models.ProjectType(id=2,
+                                           created_at=created_at,
+                                           created_by='test',
+                                           last_modified_at=None,
+                                           last_modified_by=None,
+                                           name='API',
+                                           slug='api',
+                                           plural_name='APIs',
+                                           description=None,
+                                           icon_class='fas fa-blind',
+                                           environment_urls=False,
+                                           gitlab_project_prefix='apis'),
+        'name': 'Project',
+        'slug': 'my-project',
+        'description': 'A project',
+        'environments': ['production', 'testing'],
+        'archived': False,
+        'gitlab_project_id': 4,
+        'sentry_project_slug': None,
+        'sonarqube_project_key': None,
+        'pagerduty_service_id': None,
+        'facts': {},
+        'links': {
+            'Source Code': 'https://example.com/src'
+        },
+        'urls': {},
+        'project_score': 0,
+    }
+    values.update(overrides)
+    return models.Project(**values)
+
+
+def create_application(**automation_settings) -> unittest.mock.Mock:
+    settings = {'gitlab': {}, 'isort': {}, 'sonarqube': {}, 'yapf': {}}
+    settings.update(automation_settings)
+    return unittest.mock.Mock(settings={'automations': settings})
+
+
+class PreparedStatementsTestCase(base.TestCaseWithReset):
+
+    ADMIN_ACCESS = True
+    TRUNCATE_TABLES = [
+        'v1.cookie_cutters', 'v1.environments', 'v1.namespaces',
+        'v1.project_link_types', 'v1.project_types'
+    ]
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.project = self.create_project()
+        self.project_link_type = self.create_project_link_type()
+
+    def test_create_and_link(self):
+        url = 'https://gitlab.example.com/{}'.format(uuid.uuid4())
+        self.run_until_complete(
+            self.postgres_execute(
+                gitlab.GitLabCreateProjectAutomation.CREATE_AND_LINK_SQL, {
+                    'gitlab_project_id': 1234,
+                    'link_type_id': self.project_link_type['id'],
+                    'project_id': self.project['id'],
+                    'url': url,
+                    'username': self.USERNAME[self.ADMIN_ACCESS],
+                }))
+        result = self.run_until_complete(
+            self.postgres_execute(
+                'SELECT gitlab_project_id FROM v1.projects'
+                ' WHERE id = %(id)s', {'id': self.project['id']}))
+        self.assertEqual(result.row['gitlab_project_id'], 1234)
+        result = self.run_until_complete(
+            self.postgres_execute(
+                'SELECT link_type_id, created_by, url'
+                '  FROM v1.project_links WHERE project_id = %(id)s',
+                {'id': self.project['id']}))
+        self.assertEqual(result.rows, [{
+            'link_type_id': self.project_link_type['id'],
+            'created_by': self.USERNAME[self.ADMIN_ACCESS],
+            'url': url,
+        }])
+
+    def test_create_without_link(self):
+        self.run_until_complete(
+            self.postgres_execute(
+                gitlab.GitLabCreateProjectAutomation.CREATE_AND_LINK_SQL, {
+                    'gitlab_project_id': 1234,
+                    'link_type_id': None,
+                    'project_id': self.project['id'],
+                    'url': 'https://gitlab.example.com/project',
+                    'username': self.USERNAME[self.ADMIN_ACCESS],
+                }))
+        result = self.run_until_complete(
+            self.postgres_execute(
+                'SELECT gitlab_project_id FROM v1.projects'
+                ' WHERE id = %(id)s', {'id': self.project['id']}))
+        self.assertEqual(result.row['gitlab_project_id'], 1234)
+        result = self.run_until_complete(
+            self.postgres_execute(
+                'SELECT * FROM v1.project_links WHERE project_id = %(id)s',
+                {'id': self.project['id']}))
+        self.assertEqual(result.row_count, 0)
+
+    def test_parameter_types_match_columns(self):
+        columns = {
+            'gitlab_create_and_link': [('projects', 'id'),
+                                       ('projects', 'gitlab_project_id'),
+                                       ('project_links', 'link_type_id'),
+                                       ('project_links', 'created_by'),
+                                       ('project_links', 'url')],
+            'gitlab_get_cookie_cutter': [('cookie_cutters', 'url')],
+        }
+        result = self.run_until_complete(
+            self.postgres_execute(
+                'SELECT table_name, column_name, data_type'
+                '  FROM information_schema.columns'
+                " WHERE table_schema = 'v1'", {}))
+        data_types = {(row['table_name'], row['column_name']): row['data_type']
+                      for row in result.rows}
+        result = self.run_until_complete(
+            self.postgres_execute(
+                'SELECT name, parameter_types::text[] AS parameter_types'
+                '  FROM pg_prepared_statements', {}))
+        parameter_types = {
+            row['name']: row['parameter_types']
+            for row in result.rows
+        }
+        for name, expectation in columns.items():
+            self.assertEqual(parameter_types[name],
+                             [data_types[column] for column in expectation],
+                             name)
+
+    def test_get_cookie_cutter(self):
+        record = {
+            'name': str(uuid.uuid4()),
+            'type': 'project',
+            'project_type_id': self.project_type['id'],
+            'url': 'https://{}/{}.git'.format(uuid.uuid4(), uuid.uuid4())
+        }
+        result = self.fetch('/cookie-cutters', method='POST', json_body=record)
+        self.assertEqual(result.code, 200)
+        result = self.run_until_complete(
+            self.postgres_execute(
+                gitlab.GitLabInitialCommitAutomation.GET_COOKIE_CUTTER,
+                {'url': record['url']}))
+        self.assertEqual(
+            result.row, {
+                'name': record['name'],
+                'project_type_id': record['project_type_id'],
+                'url': record['url'],
+            })
+
+
+class PrepareStatementsTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_failure_does_not_stop_other_statements(self):
+        cursor = unittest.mock.AsyncMock()
+        cursor.execute.side_effect = [psycopg2.Error('missing table'), None]
+        conn = unittest.mock.Mock()
+        conn.cursor.return_value.__aenter__ = unittest.mock.AsyncMock(
+            return_value=cursor)
+        conn.cursor.return_value.__aexit__ = unittest.mock.AsyncMock(
+            return_value=False)
+
+        with self.assertLogs('imbi.automations', 'WARNING'):
+            await automations.prepare_statements(conn)
+        self.assertEqual(
+            cursor.execute.await_args_list,
+            [unittest.mock.call(sql) for sql in gitlab.PREPARED_STATEMENTS])
+
+
+class InitialCommitPrepareTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.cookie_cutter_url = 'https://gitlab.example.com/template.git'
+        self.project = create_project(gitlab_project_id=None)
+        self.tokens = [unittest.mock.Mock()]
+        self.user = unittest.mock.Mock()
+        self.user.fetch_integration_tokens = self.fetch_integration_tokens
+        self.db = unittest.mock.Mock()
+        self.db.execute = unittest.mock.AsyncMock(
+            return_value=unittest.mock.Mock(row_count=0))
+        patcher = unittest.mock.patch.object(
+            models,
+            'project',
+            new_callable=unittest.mock.AsyncMock,
+            return_value=self.project)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.automation = gitlab.GitLabInitialCommitAutomation(
+            create_application(), self.project.id, self.cookie_cutter_url,
+            self.user, self.db)
+
+    async def fetch_integration_tokens(self, _integration):
+        # Finish after the other lookups to show that errors are still
+        # reported in lookup order
+        await asyncio.sleep(0.01)
+        return self.tokens
+
+    async def test_missing_cookie_cutter_does_not_hide_project(self):
+        errors = await self.automation.prepare()
+        self.assertEqual(errors, [
+            f'Cookie cutter {self.cookie_cutter_url} does not exist',
+            f'GitLab project does not exist for {self.project.slug}',
+        ])
+
+    async def test_errors_are_in_lookup_order(self):
+        self.tokens = []
+        errors = await self.automation.prepare()
+        self.assertEqual(errors, [
+            'GitLab token not found for current user',
+            f'Cookie cutter {self.cookie_cutter_url} does not exist',
+            f'GitLab project does not exist for {self.project.slug}',
+        ])
+
+
+class FlattenTestCase(unittest.TestCase):
+    def test_project_context(self):
+        project = create_project()
+        context = dict(
+            gitlab._flatten({'project': gitlab._shallow_asdict(project)}))
+        self.assertEqual(
+            context, {
+                'project_id': 3,
+                'project_created_at': project.created_at,
+                'project_created_by': 'test',
+                'project_last_modified_at': None,
+                'project_last_modified_by': None,
+                'project_namespace_id': 1,
+                'project_namespace_created_at': project.created_at,
+                'project_namespace_created_by': 'test',
+                'project_namespace_last_modified_at': None,
+                'project_namespace_last_modified_by': None,
+                'project_namespace_name': 'Namespace',
+                'project_namespace_slug': 'ns',
+                'project_namespace_icon_class': 'fas fa-blind',
+                'project_namespace_maintained_by': ['team-a', 'team-b'],
+                'project_namespace_gitlab_group_name': 'Group',
+                'project_namespace_sentry_team_slug': None,
+                'project_project_type_id': 2,
+                'project_project_type_created_at': project.created_at,
+                'project_project_type_created_by': 'test',
+                'project_project_type_last_modified_at': None,
+                'project_project_type_last_modified_by': None,
+                'project_project_type_name': 'API',
+                'project_project_type_slug': 'api',
+                'project_project_type_plural_name': 'APIs',
+                'project_project_type_description': None,
+                'project_project_type_icon_class': 'fas fa-blind',
+                'project_project_type_environment_urls': False,
+                'project_project_type_gitlab_project_prefix': 'apis',
+                'project_name': 'Project',
+                'project_slug': 'my-project',
+                'project_description': 'A project',
+                'project_environments': ['production', 'testing'],
+                'project_archived': False,
+                'project_gitlab_project_id': 4,
+                'project_sentry_project_slug': None,
+                'project_sonarqube_project_key': None,
+                'project_pagerduty_service_id': None,
+                'project_facts': {},
+                'project_links_Source Code': 'https://example.com/src',
+                'project_urls': {},
+                'project_project_score': 0,
+            })
+
+
+class FetchTemplateTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+        patcher = unittest.mock.patch.dict(gitlab._template_dirs, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def clone(repo_url, clone_to_dir, no_input):
+        repo_dir = os.path.join(clone_to_dir, repo_url.rsplit('/', 1)[-1])
+        os.makedirs(repo_dir, exist_ok=True)
+        return repo_dir
+
+    def fetch_template(self, url: str) -> str:
+        automation = gitlab.GitLabInitialCommitAutomation(
+            create_application(cookiecutter_cache_dir=self.cache_dir.name), 3,
+            url, unittest.mock.Mock(), unittest.mock.Mock())
+        automation._cookie_cutter = models.CookieCutter(name='Template',
+                                                        project_type_id=1,
+                                                        url=url)
+        return automation._fetch_template()
+
+    def test_same_basename_is_cloned_separately(self):
+        with unittest.mock.patch('cookiecutter.vcs.clone',
+                                 side_effect=self.clone) as clone:
+            first = self.fetch_template('https://gitlab.example.com/a/t.git')
+            second = self.fetch_template('https://gitlab.example.com/b/t.git')
+        self.assertEqual(clone.call_count, 2)
+        self.assertNotEqual(first, second)
+        self.assertTrue(os.path.isdir(first))
+        self.assertTrue(os.path.isdir(second))
+        self.assertEqual(
+            gitlab._template_dirs, {
+                'https://gitlab.example.com/a/t.git': first,
+                'https://gitlab.example.com/b/t.git': second,
+            })
+
+    def test_zip_file_is_not_cloned(self):
+        url = 'https://gitlab.example.com/t/template.zip'
+        with unittest.mock.patch('cookiecutter.vcs.clone') as clone:
+            self.assertEqual(self.fetch_template(url), url)
+        clone.assert_not_called()
+
+    def test_pull_timeout_clones_again(self):
+        url = 'https://gitlab.example.com/a/t.git'
+        with unittest.mock.patch('cookiecutter.vcs.clone',
+                                 side_effect=self.clone) as clone, \
+                unittest.mock.patch.object(
+                    gitlab.subprocess, 'check_output',
+                    side_effect=subprocess.TimeoutExpired('git', 60)) as pull:
+            first = self.fetch_template(url)
+            second = self.fetch_template(url)
+        self.assertEqual(first, second)
+        self.assertEqual(clone.call_count, 2)
+        pull.assert_called_once()
+        self.assertEqual(pull.call_args.kwargs['timeout'],
+                         gitlab._PULL_TIMEOUT)
+
+
+class ReformatProjectTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.project_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.project_dir.cleanup)
+        for name in ['_format_pool', '_format_semaphore']:
+            patcher = unittest.mock.patch.object(gitlab, name, None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addAsyncCleanup(gitlab.shutdown_format_pool)
+        self.automation = self.create_automation()
+
+    @staticmethod
+    def create_automation(**automation_settings) \
+            -> gitlab.GitLabInitialCommitAutomation:
+        automation_settings.setdefault('yapf', 'pep8')
+        automation = gitlab.GitLabInitialCommitAutomation(
+            create_application(**automation_settings), 3, 'template',
+            unittest.mock.Mock(), unittest.mock.Mock())
+        automation._project = create_project()
+        return automation
+
+    def use_thread_pool(self, workers: int) -> None:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.addCleanup(pool.shutdown)
+        gitlab._format_pool = pool
+        gitlab._format_semaphore = asyncio.Semaphore(workers)
+
+    def write_file(self, name: str, source: str) -> None:
+        with open(os.path.join(self.project_dir.name, name), 'w') as handle:
+            handle.write(source)
+
+    async def test_reformat_error(self):
+        self.write_file('valid.py', 'x = {  "a":37 }\n')
+        self.write_file('invalid.py', 'def broken(:\n')
+        with self.assertRaises(gitlab.ReformatError) as context:
+            await self.automation._reformat_project(
+                pathlib.Path(self.project_dir.name))
+        self.assertIn('invalid.py', str(context.exception))
+
+    async def test_isort_skip_setting(self):
+        self.write_file('legacy.py', 'import sys\nimport os\n')
+        self.write_file('module.py', 'import sys\nimport os\n')
+        automation = self.create_automation(isort={'skip': ['legacy.py']},
+                                            yapf=None)
+        result = await automation._reformat_project(
+            pathlib.Path(self.project_dir.name))
+        self.assertEqual(
+            result, {
+                'legacy.py': b'import sys\nimport os\n',
+                'module.py': b'import os\nimport sys\n',
+            })
+
+    async def test_pool_is_shared(self):
+        self.write_file('module.py', 'x = {  "a":37 }\n')
+        with unittest.mock.patch.object(
+                gitlab.concurrent.futures,
+                'ProcessPoolExecutor',
+                wraps=concurrent.futures.ProcessPoolExecutor) as pool_class:
+            results = await asyncio.gather(*[
+                self.create_automation()._reformat_project(
+                    pathlib.Path(self.project_dir.name)) for _ in range(3)
+            ])
+        self.assertEqual(results, [{'module.py': b'x = {"a": 37}\n'}] * 3)
+        pool_class.assert_called_once()
+        kwargs = pool_class.call_args.kwargs
+        self.assertEqual(kwargs['max_workers'], os.cpu_count())
+        self.assertEqual(kwargs['mp_context'].get_start_method(), 'forkserver')
+
+    async def test_failure_waits_for_other_files(self):
+        files = ['module_{}.py'.format(i) for i in range(8)]
+        for name in files:
+            self.write_file(name, 'x = 1\n')
+
+        def format_one(path, _isort_config, _yapf_style):
+            if path.endswith(files[0]):
+                raise gitlab.ReformatError('failed')
+            return b'x = 1\n'
+
+        self.use_thread_pool(2)
+        with unittest.mock.patch.object(gitlab,
+                                        '_format_one',
+                                        side_effect=format_one) as mock:
+            with self.assertRaises(gitlab.ReformatError):
+                await self.automation._reformat_project(
+                    pathlib.Path(self.project_dir.name))
+        self.assertEqual(mock.call_count, len(files))
+
+    async def test_broken_pool_is_discarded(self):
+        self.write_file('module.py', 'x = 1\n')
+        self.use_thread_pool(1)
+        with unittest.mock.patch.object(
+                gitlab,
+                '_format_one',
+                side_effect=concurrent.futures.process.BrokenProcessPool):
+            with self.assertRaises(concurrent.futures.BrokenExecutor):
+                await self.automation._reformat_project(
+                    pathlib.Path(self.project_dir.name))
+        self.assertIsNone(gitlab._format_pool)
+        self.assertIsNone(gitlab._format_semaphore)
+
+
+class RenderTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = pathlib.Path(temp_dir.name)
+        config_file = self.temp_dir / 'cookiecutter.yaml'
+        config_file.write_text('replay_dir: {}\n'.format(self.temp_dir /
+                                                         'replay'))
+        patchers = [
+            unittest.mock.patch.dict(
+                os.environ, {'COOKIECUTTER_CONFIG': str(config_file)}),
+            unittest.mock.patch.object(gitlab, '_render_lock', None),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def create_template(self, name: str) -> str:
+        template = self.temp_dir / name
+        project = template / '{{cookiecutter.name}}'
+        project.mkdir(parents=True)
+        (template / 'cookiecutter.json').write_text('{"name": "project"}')
+        for offset in range(50):
+            (project / '{}{}.txt'.format(
+                name, offset)).write_text('{{cookiecutter.name}}\n')
+        return str(template)
+
+    async def test_templates_render_one_at_a_time(self):
+        cwd = os.getcwd()
+        output_dirs = [self.temp_dir / 'output-a', self.temp_dir / 'output-b']
+        project_dirs = await asyncio.gather(*[
+            gitlab.GitLabInitialCommitAutomation._render(
+                self.create_template(name), {'name': name}, str(output_dir))
+            for name, output_dir in zip(['a', 'b'], output_dirs)
+        ])
+        self.assertEqual(os.getcwd(), cwd)
+        for name, project_dir in zip(['a', 'b'], project_dirs):
+            project_dir = pathlib.Path(project_dir)
+            self.assertEqual(project_dir.name, name)
+            self.assertEqual(
+                sorted(path.name for path in project_dir.iterdir()),
+                sorted('{}{}.txt'.format(name, offset)
+                       for offset in range(50)))
@@ -0,0 +1,85 @@
+import base64
+import os
+import pathlib
+import stat
+import tempfile
+import unittest
+import unittest.mock
+
+from imbi.automations import gitlab as automation
+from imbi.clients import gitlab
+
+
+class CommitTreeTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.project_dir = pathlib.Path(temp_dir.name)
+        (self.project_dir / 'package').mkdir()
+        (self.project_dir / 'package' / '__init__.py').write_bytes(b'x=1\n')
+        (self.project_dir / 'README.md').write_bytes(b'# Project\n')
+        script = self.project_dir / 'bootstrap'
+        script.write_bytes(b'#!/bin/sh\n')
+        script.chmod(script.stat().st_mode | stat.S_IXUSR)
+
+        application = unittest.mock.Mock()
+        application.settings = {'automations': {'gitlab': {}}}
+        self.client = gitlab.GitLabClient(unittest.mock.Mock(), application)
+        self.client.api = unittest.mock.AsyncMock(
+            return_value=unittest.mock.Mock(ok=True, body={'id': 'abc'}))
+        self.project_info = gitlab.ProjectInfo.parse_obj({
+            'id': 1,
+            'default_branch': 'main',
+            'namespace': {
+                'id': 2
+            },
+            'web_url': 'https://gitlab.example.com/ns/project',
+            '_links': {
+                'self': 'https://gitlab.example.com/api/v4/projects/1'
+            },
+        })
+
+    async def commit_tree(self, blobs) -> dict:
+        result = await self.client.commit_tree(self.project_info,
+                                               self.project_dir,
+                                               'Initial commit', blobs)
+        self.assertEqual(result, {'id': 'abc'})
+        return self.client.api.await_args.kwargs['body']
+
+    async def test_blobs_override_files(self):
+        # Keyed the same way the automation keys its reformatted files
+        blobs = {
+            os.path.relpath(path, self.project_dir): b'x = 1\n'
+            for path in automation._iter_py(str(self.project_dir))
+        }
+        body = await self.commit_tree(blobs)
+        self.assertEqual(body['branch'], 'main')
+        self.assertEqual(body['commit_message'], 'Initial commit')
+        contents = {
+            action['file_path']: base64.b64decode(action['content'])
+            for action in body['actions'] if action['action'] == 'create'
+        }
+        self.assertEqual(
+            contents, {
+                os.path.join('package', '__init__.py'): b'x = 1\n',
+                'README.md': b'# Project\n',
+                'bootstrap': b'#!/bin/sh\n',
+            })
+        self.assertEqual(len(body['actions']), 4)
+        self.assertIn(
+            {
+                'action': 'chmod',
+                'execute_filemode': True,
+                'file_path': 'bootstrap',
+            }, body['actions'])
+
+    async def test_without_blobs(self):
+        body = await self.commit_tree(None)
+        contents = {
+            action['file_path']: base64.b64decode(action['content'])
+            for action in body['actions'] if action['action'] == 'create'
+        }
+        self.assertEqual(contents[os.path.join('package', '__init__.py')],
+                         b'x=1\n')
+        self.assertEqual(len(body['actions']), 4)